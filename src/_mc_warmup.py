@@ -0,0 +1,37 @@
+"""
+Precompilation of the Monte Carlo Kernel.
+
+The Numba engine's per-path kernel is compiled with njit(cache=True), so its
+machine code is written to Numba's on-disk cache (src/__pycache__) and later
+processes load it instead of compiling it again. Running
+`python -m src._mc_warmup` from the project root fills that cache ahead of
+time, so even the first path-dependent simulation in a fresh environment does
+not pay the JIT compile. The cached kernel keeps its parallel loop.
+
+Numba recompiles (and re-caches) automatically whenever _mc_kernel changes.
+"""
+import numpy as np
+
+from src.monte_carlo_method import calculate_monte_carlo_var_es, nb
+
+
+def warm_up_numba_kernel():
+    """Compiles and caches the Numba kernel for every simulation dtype."""
+    warm_up_config = {
+        "portfolio_value": 1.0,
+        "weights": np.array([1.0]),
+        "confidence_level": 0.95,
+        "time_horizon_days": 1,
+        "num_simulations": 2,
+    }
+    for dtype in (np.float32, np.float64):
+        calculate_monte_carlo_var_es(
+            warm_up_config, np.zeros(1), np.eye(1), seed=0, engine="numba",
+            dtype=dtype, path_dependent=True)
+
+
+if __name__ == '__main__':
+    if nb is None:
+        raise SystemExit("numba is not installed; the NumPy engine needs no compilation.")
+    warm_up_numba_kernel()
+    print("Numba Monte Carlo kernel compiled and cached.")
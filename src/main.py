@@ -4,9 +4,11 @@ Main Orchestration Script for Portfolio Risk Calculator.
 This script loads portfolio configurations, performs VaR and ES calculations
 using different methods (Parametric, Monte Carlo), and displays the results.
 """
+import argparse
+from typing import Literal
+
 import numpy as np
-import matplotlib.pyplot as plt
-from src.utils import display_results, convert_annual_to_daily
+from src.utils import display_results, DailyModel
 from src.parametric_method import calculate_parametric_var_es
 from src.monte_carlo_method import calculate_monte_carlo_var_es
 
@@ -46,8 +48,12 @@ DEFAULT_PORTFOLIO = {
 }
 # --- End of Embedded Portfolio Configuration ---
 
+MC_MODES = ("full", "fast", "off")
+
 
-def run_risk_calculations(portfolio_config_name: str = "DEFAULT_PORTFOLIO"):
+def run_risk_calculations(portfolio_config_name: str = "DEFAULT_PORTFOLIO",
+                          plot: bool = False,
+                          mc_mode: Literal["full", "fast", "off"] = "full"):
     """
     Runs the risk calculations for a specified portfolio configuration.
 
@@ -55,7 +61,17 @@ def run_risk_calculations(portfolio_config_name: str = "DEFAULT_PORTFOLIO"):
         portfolio_config_name (str): The name of the portfolio configuration
                                      to use. Currently, only "DEFAULT_PORTFOLIO"
                                      is directly embedded.
+        plot (bool): If True, keep the simulated Monte Carlo returns and plot
+                     their histogram (imports matplotlib). Off by default so
+                     headless runs only compute the tail statistics.
+        mc_mode (str): "full" (default) runs the Monte Carlo simulation;
+                       "fast" reports the Gaussian closed-form (Parametric)
+                       answer under the Monte Carlo heading without simulating;
+                       "off" skips the Monte Carlo step entirely.
     """
+    if mc_mode not in MC_MODES:
+        raise ValueError(f"Unknown mc_mode '{mc_mode}'. Expected one of {MC_MODES}.")
+
     print(f"--- Starting Risk Calculations for: {portfolio_config_name} ---")
 
     # --- 1. Load Portfolio Configuration ---
@@ -67,27 +83,23 @@ def run_risk_calculations(portfolio_config_name: str = "DEFAULT_PORTFOLIO"):
         print(f"Warning: Portfolio '{portfolio_config_name}' not found. Using DEFAULT_PORTFOLIO.")
         current_config = DEFAULT_PORTFOLIO
 
-    # --- 2. Preparations for Monte Carlo (Daily Figures) ---
-    # These are also used by the parametric method internally, but MC needs them explicitly.
-    # It's good to calculate them once.
-    daily_returns_mc = convert_annual_to_daily(
-        current_config['expected_annual_returns'],
-        current_config['trading_days_per_year'],
-        is_volatility=False
-    )
-    daily_vols_mc = convert_annual_to_daily(
-        current_config['annual_volatilities'],
-        current_config['trading_days_per_year'],
-        is_volatility=True
-    )
-    D_daily_mc = np.diag(daily_vols_mc)
-    daily_covariance_matrix_mc = D_daily_mc @ current_config['correlation_matrix'] @ D_daily_mc
+    # --- 2. Daily Figures Shared by Both Methods ---
+    # Daily returns, the daily covariance matrix and its Cholesky factor are
+    # computed once here instead of being rebuilt inside each method.
+    daily_model = DailyModel.from_config(current_config)
+
+    # Factor the daily covariance up front so that Parametric can reuse L for
+    # w^T Sigma w; Monte Carlo needs it anyway to correlate its draws. If it is
+    # not positive definite, Parametric falls back to the quadratic form and
+    # Monte Carlo reports the error.
+    daily_model.factorize()
 
 
     # --- 3. Parametric VaR & ES Calculation ---
+    param_results = None
     try:
-        param_var_val, param_es_val, param_var_ret, param_es_ret = \
-            calculate_parametric_var_es(current_config)
+        param_results = calculate_parametric_var_es(current_config, daily_model=daily_model)
+        param_var_val, param_es_val, param_var_ret, param_es_ret = param_results
         
         display_results(
             method_name="Parametric (Variance-Covariance)",
@@ -102,64 +114,96 @@ def run_risk_calculations(portfolio_config_name: str = "DEFAULT_PORTFOLIO"):
 
 
     # --- 4. Monte Carlo VaR & ES Calculation ---
-    print(f"\nStarting Monte Carlo simulation with {current_config['num_simulations']} paths...")
-    print("(This may take a moment depending on the number of simulations and horizon)")
-    
-    # Set a seed for reproducibility of Monte Carlo results if desired for runs
-    # np.random.seed(42) # Uncomment if you want consistent MC results across runs
+    if mc_mode == "off":
+        print("\nMonte Carlo simulation skipped (mc_mode='off').")
+
+    elif mc_mode == "fast":
+        # With Gaussian returns the simulation only resamples the distribution the
+        # Parametric method already solves in closed form, so report that answer
+        # under the Monte Carlo heading instead of simulating.
+        if param_results is None:
+            print("Error during Monte Carlo calculation: Parametric results unavailable for mc_mode='fast'.")
+        else:
+            mc_var_val, mc_es_val, mc_var_ret, mc_es_ret = param_results
+            display_results(
+                method_name="Monte Carlo Simulation (fast: Gaussian closed form)",
+                var_value=mc_var_val,
+                es_value=mc_es_val,
+                var_return=mc_var_ret,
+                es_return=mc_es_ret,
+                portfolio_config=current_config
+            )
 
-    try:
-        mc_var_val, mc_es_val, mc_var_ret, mc_es_ret, all_sim_returns = \
-            calculate_monte_carlo_var_es(
-                portfolio_config=current_config,
-                daily_returns=daily_returns_mc,
-                daily_vols=daily_vols_mc, # Not strictly needed if daily_cov_matrix is passed
-                daily_covariance_matrix=daily_covariance_matrix_mc
+    else:
+        print(f"\nStarting Monte Carlo simulation with {current_config['num_simulations']} paths...")
+        print("(This may take a moment depending on the number of simulations and horizon)")
+    
+        # Set a seed for reproducibility of Monte Carlo results if desired for runs
+        mc_seed = None # e.g. 42, if you want consistent MC results across runs
+
+        try:
+            mc_var_val, mc_es_val, mc_var_ret, mc_es_ret, all_sim_returns = \
+                calculate_monte_carlo_var_es(
+                    portfolio_config=current_config,
+                    seed=mc_seed,
+                    daily_model=daily_model,
+                    return_samples=plot
+                )
+
+            display_results(
+                method_name="Monte Carlo Simulation",
+                var_value=mc_var_val,
+                es_value=mc_es_val,
+                var_return=mc_var_ret,
+                es_return=mc_es_ret,
+                portfolio_config=current_config
             )
 
-        display_results(
-            method_name="Monte Carlo Simulation",
-            var_value=mc_var_val,
-            es_value=mc_es_val,
-            var_return=mc_var_ret,
-            es_return=mc_es_ret,
-            portfolio_config=current_config
-        )
+            # --- 5. Plot Histogram of Monte Carlo Returns ---
+            # Plotting might not work in all execution environments (e.g., sandboxes without GUI)
+            if plot and all_sim_returns is not None:
+                try:
+                    import matplotlib.pyplot as plt # Only needed (and imported) when plotting
 
-        # --- 5. Plot Histogram of Monte Carlo Returns ---
-        # Plotting might not work in all execution environments (e.g., sandboxes without GUI)
-        if all_sim_returns is not None:
-            try:
-                plt.figure(figsize=(10, 6))
-                plt.hist(all_sim_returns, bins=100, alpha=0.75, color='skyblue', edgecolor='black',
-                         label=f"Simulated Portfolio Returns ({current_config['time_horizon_days']}-day horizon)")
+                    plt.figure(figsize=(10, 6))
+                    plt.hist(all_sim_returns, bins=100, alpha=0.75, color='skyblue', edgecolor='black',
+                             label=f"Simulated Portfolio Returns ({current_config['time_horizon_days']}-day horizon)")
                 
-                plt.axvline(mc_var_ret, color='red', linestyle='dashed', linewidth=2,
-                            label=f'VaR Return ({current_config["confidence_level"]*100:.1f}%): {mc_var_ret:,.4%}')
-                plt.axvline(mc_es_ret, color='black', linestyle='dashed', linewidth=2,
-                            label=f'ES Return ({current_config["confidence_level"]*100:.1f}%): {mc_es_ret:,.4%}')
+                    plt.axvline(mc_var_ret, color='red', linestyle='dashed', linewidth=2,
+                                label=f'VaR Return ({current_config["confidence_level"]*100:.1f}%): {mc_var_ret:,.4%}')
+                    plt.axvline(mc_es_ret, color='black', linestyle='dashed', linewidth=2,
+                                label=f'ES Return ({current_config["confidence_level"]*100:.1f}%): {mc_es_ret:,.4%}')
                 
-                plt.title(f"Monte Carlo Simulation: Distribution of Portfolio Returns\n"
-                          f"{current_config['name']} - {current_config['num_simulations']} Simulations")
-                plt.xlabel(f"{current_config['time_horizon_days']}-Day Portfolio Return")
-                plt.ylabel("Frequency")
-                plt.legend()
-                plt.grid(True, linestyle='--', alpha=0.7)
-                # NB - You might want to save the plot to a file instead of showing it directly
-                # plt.savefig("monte_carlo_returns_histogram.png")
-                # plt.show() # This will block execution until the plot window is closed.
-                print("\nPlot generated (plt.show() is commented out for non-interactive environments).")
-                # In a script, plt.show() would typically be used. For sandboxes, saving might be better.
-            except Exception as plot_e:
-                print(f"Note: Plotting failed or was skipped. Error: {plot_e}")
+                    plt.title(f"Monte Carlo Simulation: Distribution of Portfolio Returns\n"
+                              f"{current_config['name']} - {current_config['num_simulations']} Simulations")
+                    plt.xlabel(f"{current_config['time_horizon_days']}-Day Portfolio Return")
+                    plt.ylabel("Frequency")
+                    plt.legend()
+                    plt.grid(True, linestyle='--', alpha=0.7)
+                    # NB - You might want to save the plot to a file instead of showing it directly
+                    # plt.savefig("monte_carlo_returns_histogram.png")
+                    # plt.show() # This will block execution until the plot window is closed.
+                    print("\nPlot generated (plt.show() is commented out for non-interactive environments).")
+                    # In a script, plt.show() would typically be used. For sandboxes, saving might be better.
+                except Exception as plot_e:
+                    print(f"Note: Plotting failed or was skipped. Error: {plot_e}")
 
 
-    except Exception as e:
-        print(f"Error during Monte Carlo calculation: {e}")
+        except Exception as e:
+            print(f"Error during Monte Carlo calculation: {e}")
+
 
     print("\n--- Risk Calculations Finished ---")
 
 
 if __name__ == "__main__":
- 
-    run_risk_calculations(portfolio_config_name="DEFAULT_PORTFOLIO")
+    parser = argparse.ArgumentParser(description="Portfolio VaR and ES calculator.")
+    parser.add_argument("--plot", action="store_true",
+                        help="Plot a histogram of the simulated Monte Carlo returns.")
+    parser.add_argument("--mc-mode", choices=MC_MODES, default="full",
+                        help="'full' simulates, 'fast' reports the Gaussian closed form, "
+                             "'off' skips Monte Carlo.")
+    args = parser.parse_args()
+
+    run_risk_calculations(portfolio_config_name="DEFAULT_PORTFOLIO", plot=args.plot,
+                          mc_mode=args.mc_mode)
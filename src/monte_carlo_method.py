@@ -5,13 +5,114 @@ This module implements the logic to calculate Value-at-Risk (VaR) and
 Expected Shortfall (ES) using Monte Carlo simulation.
 """
 import numpy as np
-# from .utils import convert_annual_to_daily # If needed and not passed differently
+
+from src.utils import DailyModel
+
+# Numba is optional: without it only the vectorized NumPy engine is available.
+try:
+    import numba as nb
+except ImportError:
+    nb = None
+
+MC_ENGINES = ("auto", "numpy", "numba")
+
+# Paths simulated per tile by the NumPy engine. A tile of draws is
+# time_horizon * chunk_size * num_assets values, which keeps it in L2 for
+# typical horizons and portfolio sizes.
+DEFAULT_CHUNK_SIZE = 4096
+
+# Paths per independently seeded random stream in the Numba engine.
+_NUMBA_SEED_BLOCK_SIZE = 1024
+
+
+def _mc_kernel(Lt_w, mu_w, time_horizon, block_seeds, antithetic, block_size, out):
+    """
+    Simulates horizon portfolio returns path by path into `out` (Numba engine).
+
+    Each path compounds its daily portfolio returns w^T mu + (L^T w)^T z as a
+    running sum of log1p(r). Every standard normal is drawn and immediately
+    folded into the day's return, so the draws never touch memory and the
+    loop body stays in registers. With `antithetic`, each set of draws also
+    drives a mirrored path using -z, stored next to it. Every path is computed
+    in float64 and stored as out's dtype; one path is simulated per entry of `out`.
+
+    Paths are processed in blocks of `block_size`, and block b reseeds its
+    thread's random state with block_seeds[b] (one seed per block, drawn
+    independently by the caller). The result therefore does not depend on how
+    the parallel loop is scheduled across threads.
+    Written as a plain loop nest so it can be compiled with numba.njit.
+    """
+    num_assets = Lt_w.shape[0]
+    num_simulations = out.shape[0]
+    num_drawn_paths = (num_simulations + 1) // 2 if antithetic else num_simulations
+    for block in nb.prange(block_seeds.shape[0]):
+        np.random.seed(block_seeds[block])
+        for i in range(block * block_size, min((block + 1) * block_size, num_drawn_paths)):
+            log_growth = 0.0
+            log_growth_mirrored = 0.0
+            for _ in range(time_horizon):
+                shock = 0.0
+                for a in range(num_assets):
+                    shock += Lt_w[a] * np.random.standard_normal()
+                log_growth += np.log1p(mu_w + shock)
+                if antithetic:
+                    log_growth_mirrored += np.log1p(mu_w - shock)
+            if antithetic:
+                out[2 * i] = np.expm1(log_growth)
+                if 2 * i + 1 < num_simulations:
+                    out[2 * i + 1] = np.expm1(log_growth_mirrored)
+            else:
+                out[i] = np.expm1(log_growth)
+
+
+if nb is not None:
+    _mc_kernel = nb.njit(parallel=True, fastmath=True, cache=True)(_mc_kernel)
+
+
+def _draw_buffer_size(time_horizon: int, num_simulations: int, num_assets: int,
+                      chunk_size: int, antithetic: bool) -> int:
+    """Number of entries in the NumPy engine's per-tile draw buffer."""
+    max_tile_paths = min(chunk_size, num_simulations)
+    max_drawn_paths = (max_tile_paths + 1) // 2 if antithetic else max_tile_paths
+    return time_horizon * max_drawn_paths * num_assets
+
+
+def monte_carlo_workspace_size(portfolio_config: dict,
+                               chunk_size: int = DEFAULT_CHUNK_SIZE,
+                               antithetic: bool = False,
+                               path_dependent: bool = False) -> int:
+    """
+    Returns the workspace length that calculate_monte_carlo_var_es can run in
+    without allocating any simulation buffer.
+
+    That is num_simulations entries for the simulated horizon returns plus,
+    with path_dependent=True, the NumPy engine's per-tile draw buffer of
+    time_horizon * chunk_size * num_assets standard normals (half the paths
+    with antithetic variates). Pass the same chunk_size/antithetic/path_dependent
+    as to calculate_monte_carlo_var_es.
+    """
+    num_simulations = portfolio_config['num_simulations']
+    size = num_simulations
+    if path_dependent:
+        size += _draw_buffer_size(portfolio_config['time_horizon_days'], num_simulations,
+                                  len(portfolio_config['weights']), chunk_size, antithetic)
+    return size
+
 
 def calculate_monte_carlo_var_es(portfolio_config: dict,
                                  # Pre-calculated daily figures can be passed for efficiency
-                                 daily_returns: np.ndarray,
-                                 daily_vols: np.ndarray,
-                                 daily_covariance_matrix: np.ndarray): # or L_matrix
+                                 daily_returns: np.ndarray = None,
+                                 daily_covariance_matrix: np.ndarray = None,
+                                 seed: int = None,
+                                 rng: np.random.Generator = None,
+                                 engine: str = "auto",
+                                 daily_model: DailyModel = None,
+                                 dtype=np.float32,
+                                 chunk_size: int = DEFAULT_CHUNK_SIZE,
+                                 antithetic: bool = False,
+                                 return_samples: bool = False,
+                                 path_dependent: bool = False,
+                                 workspace: np.ndarray = None):
     """
     Calculates VaR and ES using the Monte Carlo simulation method.
 
@@ -23,10 +124,57 @@ def calculate_monte_carlo_var_es(portfolio_config: dict,
             - 'time_horizon_days': int
             - 'num_simulations': int
         daily_returns (np.ndarray): Expected daily returns for each asset.
-        daily_vols (np.ndarray): Expected daily volatilities for each asset.
-                                 (Used here if L_matrix is not pre-computed from daily_cov)
         daily_covariance_matrix (np.ndarray): Daily covariance matrix of asset returns.
                                               Used to derive Cholesky factor L.
+        seed (int, optional): Seed for the NumPy random Generator used to draw the
+                              standard normals. None (default) draws fresh entropy.
+        rng (np.random.Generator, optional): Generator to draw from instead of
+                              creating one from `seed`, e.g. a shared
+                              np.random.default_rng() (PCG64) or
+                              np.random.Generator(np.random.Philox(key)) for
+                              independent parallel streams. Mutually exclusive with seed.
+        engine (str): Day-by-day simulation engine (used with path_dependent=True).
+                      "numpy" simulates the paths with vectorized array operations;
+                      "numba" runs a JIT-compiled, parallel per-path loop that never
+                      materializes the random draws (requires numba; the compiled
+                      kernel is cached on disk, and `python -m src._mc_warmup`
+                      precompiles it). "auto" (default) uses "numba" when it is
+                      installed, else "numpy".
+        daily_model (DailyModel, optional): Pre-built daily return model (daily
+                      returns, covariance and cached Cholesky factor), e.g. shared
+                      with the Parametric method. Takes the place of
+                      daily_returns/daily_covariance_matrix when given.
+        dtype: Floating-point type of the NumPy engine's simulation arrays.
+               float32 (default) halves memory traffic; its rounding error is far
+               below the ~1/sqrt(N) Monte Carlo error. VaR/ES are always returned
+               as float64. The Numba engine computes each path in float64 and
+               stores it as dtype.
+        chunk_size (int): Number of paths the NumPy engine simulates per tile
+                          (default DEFAULT_CHUNK_SIZE). Bounds the working set to
+                          (time_horizon, chunk_size, num_assets) random draws.
+        antithetic (bool): If True, use antithetic variates: only half of the
+                           paths get fresh draws Z, the other half reuse -Z.
+                           Halves the random numbers generated and reduces the
+                           variance of the estimates at the same num_simulations.
+        return_samples (bool): If True, also return the simulated horizon returns
+                               (e.g. for plotting a histogram). Defaults to False,
+                               in which case None is returned in their place.
+        path_dependent (bool): If True, simulate every day of the horizon and
+                               compound (needed for path-dependent extensions;
+                               `engine` and `chunk_size` apply). If False (default),
+                               draw each path's horizon return in one step from
+                               its closed-form distribution (see Assumptions).
+        workspace (np.ndarray, optional): Preallocated 1-D buffer of `dtype`, e.g.
+                               allocated once by a backtest that calls this
+                               function for every window. Its first num_simulations
+                               entries receive the simulated horizon returns (with
+                               return_samples the returned samples are a view of
+                               them); the NumPy engine with path_dependent=True
+                               draws its tiles into the entries after those if
+                               there is room. monte_carlo_workspace_size() gives
+                               the length that covers both. Its contents are
+                               overwritten. If None (default), the buffers are
+                               allocated per call.
 
     Returns:
         tuple: (var_value, es_value, var_return, es_return, all_sim_returns)
@@ -34,12 +182,21 @@ def calculate_monte_carlo_var_es(portfolio_config: dict,
                - es_value (float): Expected Shortfall as a positive loss value.
                - var_return (float): VaR as a negative return.
                - es_return (float): ES as a negative return.
-               - all_sim_returns (np.ndarray): Array of all simulated portfolio returns
-                                               over the horizon for plotting/analysis.
+               - all_sim_returns (np.ndarray or None): Array of all simulated portfolio
+                                               returns over the horizon for plotting/analysis,
+                                               or None unless return_samples is True.
+                                               Only partially ordered: the tail used
+                                               for VaR/ES comes first (unsorted), ending
+                                               at the VaR return.
     Assumptions:
         - Asset returns can be modeled by a multivariate normal distribution
           (or other specified distribution if generation logic is changed).
         - Daily returns are IID for multi-day simulation (compounding).
+        - With path_dependent=False the daily portfolio return statistics are
+          applied to log-returns, so the horizon return is
+          expm1(T * mu_p + sqrt(T) * sigma_p * Z). Compared with compounding
+          normal daily simple returns this differs by about T * sigma_p^2 / 2 in
+          the drift, which is negligible at daily scale.
     """
     # Unpack parameters
     portfolio_value = portfolio_config['portfolio_value']
@@ -51,61 +208,143 @@ def calculate_monte_carlo_var_es(portfolio_config: dict,
 
     alpha = 1 - confidence_level
 
+    if engine not in MC_ENGINES:
+        raise ValueError(f"Unknown Monte Carlo engine '{engine}'. Expected one of {MC_ENGINES}.")
+    if engine == "numba" and nb is None:
+        raise ImportError("The 'numba' Monte Carlo engine requires the numba package.")
+    if engine == "auto":
+        engine = "numba" if nb is not None else "numpy"
+    if seed is not None and rng is not None:
+        raise ValueError("Pass either seed or rng, not both.")
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be a positive integer.")
+    dtype = np.dtype(dtype)
+    # Every engine leaves the simulated horizon returns in this buffer.
+    if workspace is not None:
+        if (workspace.ndim != 1 or workspace.dtype != dtype or workspace.size < num_simulations
+                or not workspace.flags.c_contiguous or not workspace.flags.writeable):
+            raise ValueError(
+                f"workspace must be a writeable, contiguous 1-D {dtype} array with at least "
+                f"{num_simulations} entries.")
+        sim_horizon_portfolio_returns = workspace[:num_simulations]
+    else:
+        sim_horizon_portfolio_returns = np.empty(num_simulations, dtype=dtype)
+
     # 1. Generate Correlated Daily Asset Returns
     # Cholesky Decomposition of the daily covariance matrix: L L^T = Sigma_daily
-    try:
-        L_matrix = np.linalg.cholesky(daily_covariance_matrix)
-    except np.linalg.LinAlgError:
-        # Fallback or error handling if matrix is not positive definite
-        # For simplicity, we'll raise an error. In practice, might try to find nearest PD matrix.
-        raise ValueError("Daily covariance matrix is not positive definite. Cholesky decomposition failed.")
-
-    # Array to store simulated end-of-horizon portfolio values or returns
-    sim_portfolio_end_values = np.zeros(num_simulations)
-    # Alternative: store horizon returns directly
-    sim_horizon_portfolio_returns = np.zeros(num_simulations)
-
-
-    for i in range(num_simulations):
-        current_portfolio_value_sim = portfolio_value # Start with initial value for this path
-
-        for _ in range(time_horizon): # Simulate each day in the horizon
-            # Generate 'num_assets' independent standard normal random numbers (Z_day)
-            standard_random_numbers = np.random.normal(0, 1, size=num_assets)
-            
-            # Transform to correlated daily asset returns for the current day:
-            # Delta_R_assets_day = expected_daily_returns + L * Z_day
-            sim_daily_asset_returns = daily_returns + L_matrix @ standard_random_numbers
-            
-            # Calculate simulated portfolio return for the current day:
-            # Delta_R_portfolio_day = w^T * Delta_R_assets_day
-            sim_daily_portfolio_return = np.dot(weights, sim_daily_asset_returns)
-            
-            # Update the portfolio value for this simulation path for this day
-            current_portfolio_value_sim *= (1 + sim_daily_portfolio_return)
-        
-        # Store the final portfolio value for this simulation path
-        sim_portfolio_end_values[i] = current_portfolio_value_sim
-        # Or calculate and store the total return over the horizon for this path
-        sim_horizon_portfolio_returns[i] = (current_portfolio_value_sim / portfolio_value) - 1
-
-
-    # 2. Calculate Simulated Portfolio P&L and Returns (if using end_values)
-    # sim_portfolio_pnl = sim_portfolio_end_values - portfolio_value
-    # sim_portfolio_returns = sim_portfolio_pnl / portfolio_value
-    # We are using sim_horizon_portfolio_returns directly
+    # (computed once and cached on the DailyModel; raises ValueError if not positive definite)
+    if daily_model is None:
+        daily_model = DailyModel(mu=daily_returns, cov=daily_covariance_matrix)
+    daily_returns = daily_model.mu
+    L_matrix = daily_model.L
+
+    # Only the portfolio return is needed, never the per-asset return vector:
+    # w^T (mu + L z) = w^T mu + (L^T w)^T z
+    # so collapse the weights into the drift and the Cholesky factor once.
+    mu_w = float(np.dot(weights, daily_returns))
+    Lt_w = L_matrix.T @ weights
+
+    if rng is None:
+        rng = np.random.default_rng(seed)
+    if not path_dependent:
+        # Under the IID-normal model the horizon log-return is itself normal with
+        # mean T * mu_p and variance T * sigma_p^2, where sigma_p^2 = ||L^T w||^2.
+        # One draw per path replaces the whole day-by-day simulation. The horizon
+        # covariance T * Sigma has Cholesky factor sqrt(T) * L, so nothing is refactorized.
+        horizon_mean = time_horizon * mu_w
+        horizon_volatility = np.sqrt(time_horizon * float(Lt_w @ Lt_w))
+        num_drawn_paths = (num_simulations + 1) // 2 if antithetic else num_simulations
+        # Draw straight into the output buffer and transform it in place.
+        rng.standard_normal(dtype=dtype, out=sim_horizon_portfolio_returns[:num_drawn_paths])
+        if antithetic:
+            np.negative(sim_horizon_portfolio_returns[:num_simulations - num_drawn_paths],
+                        out=sim_horizon_portfolio_returns[num_drawn_paths:])
+        sim_horizon_portfolio_returns *= dtype.type(horizon_volatility)
+        sim_horizon_portfolio_returns += dtype.type(horizon_mean)
+        np.expm1(sim_horizon_portfolio_returns, out=sim_horizon_portfolio_returns)
+    elif engine == "numba":
+        # The kernel draws from Numba's own per-thread random states. Draw an
+        # independent seed for every block from the Generator, so that `seed`/`rng`
+        # still control the engine and different calls do not share runs of paths
+        # (as consecutive seeds seed + block would). Numba seeds its MT19937 state
+        # from 32 bits, so the seeds are drawn as uint32.
+        num_drawn_paths = (num_simulations + 1) // 2 if antithetic else num_simulations
+        num_blocks = (num_drawn_paths + _NUMBA_SEED_BLOCK_SIZE - 1) // _NUMBA_SEED_BLOCK_SIZE
+        block_seeds = rng.integers(2**32, size=num_blocks, dtype=np.uint32)
+        _mc_kernel(Lt_w, mu_w, time_horizon, block_seeds, antithetic,
+                   _NUMBA_SEED_BLOCK_SIZE, sim_horizon_portfolio_returns)
+    else:
+        # Simulate the paths in tiles of `chunk_size` so the draws for one tile stay
+        # cache-resident instead of materializing a full (T, N, A) tensor.
+        mu_w_sim = dtype.type(mu_w)
+        Lt_w_sim = Lt_w.astype(dtype)
+        # One flat draw buffer serves every tile; each tile uses a contiguous prefix of it.
+        # It is taken from the workspace after the returns when the workspace is long enough.
+        draw_buffer_size = _draw_buffer_size(time_horizon, num_simulations, num_assets, chunk_size, antithetic)
+        if workspace is not None and workspace.size >= num_simulations + draw_buffer_size:
+            draw_buffer = workspace[num_simulations:num_simulations + draw_buffer_size]
+        else:
+            draw_buffer = np.empty(draw_buffer_size, dtype=dtype)
+        # Bind the per-tile callables to locals once, outside the tile loop.
+        standard_normal = rng.standard_normal
+        log1p = np.log1p
+        expm1 = np.expm1
+        for start in range(0, num_simulations, chunk_size):
+            stop = min(start + chunk_size, num_simulations)
+
+            num_tile_paths = stop - start
+            # With antithetic variates only the first half of the tile gets fresh
+            # draws; the second half reuses them with the opposite sign.
+            num_drawn_paths = (num_tile_paths + 1) // 2 if antithetic else num_tile_paths
+
+            # Draw the standard normals for every day and drawn path of the tile in one call:
+            # Z has shape (time_horizon, num_drawn_paths, num_assets).
+            standard_random_numbers = draw_buffer[:time_horizon * num_drawn_paths * num_assets].reshape(
+                time_horizon, num_drawn_paths, num_assets)
+            standard_normal(dtype=dtype, out=standard_random_numbers)
+
+            # Simulated portfolio return for each day and path, shape (time_horizon, num_drawn_paths):
+            # Delta_R_portfolio_day = w^T mu + (L^T w)^T Z_day
+            # (mu_w and Lt_w are formed in float64 above and only then cast to dtype)
+            # matmul on the contiguous tile beats np.einsum('ijk,k->ij', ...) at every
+            # asset count measured (3 to 64), so no size-dependent dispatch is needed.
+            sim_daily_portfolio_shocks = standard_random_numbers @ Lt_w_sim
+            sim_daily_portfolio_returns = mu_w_sim + sim_daily_portfolio_shocks
+
+            # Compound the daily portfolio returns over the horizon for each path.
+            # prod(1 + r) - 1 == expm1(sum(log1p(r))): the sum is a plain reduction over
+            # the day axis and stays accurate for long horizons and small returns.
+            # log1p is applied in place to avoid another (time_horizon, paths) temporary.
+            sim_horizon_portfolio_returns[start:start + num_drawn_paths] = expm1(
+                log1p(sim_daily_portfolio_returns, out=sim_daily_portfolio_returns).sum(axis=0))
+
+            if antithetic:
+                # Mirrored paths: Delta_R_portfolio_day = w^T mu - (L^T w)^T Z_day
+                num_mirrored_paths = num_tile_paths - num_drawn_paths
+                sim_daily_portfolio_returns = mu_w_sim - sim_daily_portfolio_shocks[:, :num_mirrored_paths]
+                sim_horizon_portfolio_returns[start + num_drawn_paths:stop] = expm1(
+                    log1p(sim_daily_portfolio_returns, out=sim_daily_portfolio_returns).sum(axis=0))
+
+
+    # 2. Simulated Portfolio P&L and Returns
+    # Only the horizon returns are kept; no end-of-horizon portfolio values are stored.
+    # If needed they follow in one vector op: portfolio_value * (1 + sim_horizon_portfolio_returns)
 
     # 3. Calculate VaR from Simulated Portfolio Returns
-    # Sort the sim_horizon_portfolio_returns in ascending order.
-    sorted_sim_returns = np.sort(sim_horizon_portfolio_returns)
-    
     # Find the return at the alpha percentile (this is the VaR return)
     var_index = int(alpha * num_simulations) # Index for the (alpha*100)th percentile
     
     # Ensure index is within bounds, especially if alpha or num_simulations is very small
     var_index = max(0, min(var_index, num_simulations - 1))
 
-    var_mc_return = sorted_sim_returns[var_index]
+    # Only the var_index-th order statistic and the mean of the tail below it are
+    # needed, so partition (introselect, O(N)) instead of sorting: afterwards the
+    # entry at var_index is exactly the sorted one and every entry before it is <= it.
+    # The buffer belongs to this call, so it is partitioned in place (no copy).
+    sim_horizon_portfolio_returns.partition(var_index)
+    tail_sim_returns = sim_horizon_portfolio_returns[:var_index + 1]
+
+    var_mc_return = float(sim_horizon_portfolio_returns[var_index])
     
     # VaR (as a positive loss value)
     var_mc_value = -var_mc_return * portfolio_value
@@ -114,20 +353,16 @@ def calculate_monte_carlo_var_es(portfolio_config: dict,
 
     # 4. Calculate ES from Simulated Portfolio Returns
     # ES is the average of returns that are worse than or equal to the VaR return.
-    # These are the returns from index 0 up to var_index (inclusive).
-    if var_index == 0 and sorted_sim_returns[0] >= 0 : # No losses in the tail
-         es_mc_return = sorted_sim_returns[0] # Smallest return, could be positive
-    elif var_index < num_simulations -1 :
-        es_mc_return = np.mean(sorted_sim_returns[:var_index + 1])
-    else: # all simulations resulted in losses worse than var_index (highly unlikely for typical alpha)
-        es_mc_return = np.mean(sorted_sim_returns)
+    # These are the returns from index 0 up to var_index (inclusive), i.e. the tail.
+    es_mc_return = float(np.mean(tail_sim_returns, dtype=np.float64))
 
 
     # ES (as a positive loss value)
     es_mc_value = -es_mc_return * portfolio_value
     es_mc_value = max(0, es_mc_value) # Ensure non-negative loss
 
-    return var_mc_value, es_mc_value, var_mc_return, es_mc_return, sorted_sim_returns
+    all_sim_returns = sim_horizon_portfolio_returns if return_samples else None
+    return var_mc_value, es_mc_value, var_mc_return, es_mc_return, all_sim_returns
 
 
 if __name__ == '__main__':
@@ -140,8 +375,7 @@ if __name__ == '__main__':
     test_daily_vols = np.array([0.20/np.sqrt(252), 0.10/np.sqrt(252)])
     test_corr_matrix = np.array([[1.0, 0.3], [0.3, 1.0]])
     
-    D_test = np.diag(test_daily_vols)
-    test_daily_cov_matrix = D_test @ test_corr_matrix @ D_test
+    test_daily_cov_matrix = test_corr_matrix * np.outer(test_daily_vols, test_daily_vols)
 
     sample_mc_config_for_test = {
         "name": "MC Test Portfolio",
@@ -154,13 +388,11 @@ if __name__ == '__main__':
     }
     
     # Set a seed for reproducibility during testing
-    np.random.seed(42)
-
     mc_var_val, mc_es_val, mc_var_ret, mc_es_ret, _ = calculate_monte_carlo_var_es(
         sample_mc_config_for_test,
         test_daily_returns,
-        test_daily_vols, # Not directly used if daily_cov_matrix is correct
-        test_daily_cov_matrix
+        test_daily_cov_matrix,
+        seed=42
     )
 
     print(f"\n--- Monte Carlo Method Test Results (Seed=42) ---")
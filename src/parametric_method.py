@@ -5,15 +5,58 @@ This module implements the logic to calculate Value-at-Risk (VaR) and
 Expected Shortfall (ES) using the parametric method, assuming normally
 distributed returns.
 """
+import math
+
 import numpy as np
-import scipy.stats
+from scipy.special import ndtri
 
 # Changed from relative import to absolute import from 'src' package
 # This assumes the project root (parent of 'src') is in sys.path
 # when this module is run or imported.
-from src.utils import convert_annual_to_daily
+from src.utils import convert_annual_to_daily, DailyModel
+
+
+def _compute_z(confidence_level: float):
+    """
+    Returns (Z_alpha, phi(Z_alpha) / alpha) for alpha = 1 - confidence_level.
 
-def calculate_parametric_var_es(portfolio_config: dict):
+    Z_alpha is the standard normal alpha-quantile (negative for the loss tail)
+    and phi(Z_alpha) / alpha is the ES multiplier under normality. They are
+    computed with the raw special functions (no scipy.stats dispatch).
+    """
+    alpha = 1 - confidence_level
+    z_score = float(ndtri(alpha))
+    pdf_at_z_score = math.exp(-0.5 * z_score * z_score) / math.sqrt(2.0 * math.pi)
+    es_multiplier = pdf_at_z_score / alpha if alpha > 0 else math.inf
+    return z_score, es_multiplier
+
+
+# Z_alpha and the ES multiplier phi(Z_alpha) / alpha, keyed by confidence level.
+# Both depend on the confidence level alone, so they are computed once and then
+# looked up. The usual levels are computed at import and kept permanently; any
+# other level is added to _Z_CACHE on first use, where the oldest entry is
+# evicted once it is full, so callers sweeping many distinct levels neither
+# grow it without bound nor push out the usual levels.
+_Z_PRECOMPUTED = {level: _compute_z(level) for level in (0.90, 0.95, 0.975, 0.99, 0.995)}
+_Z_CACHE = {}
+_Z_CACHE_MAX_SIZE = 32
+
+
+def _get_z(confidence_level: float):
+    """Returns _compute_z(confidence_level), memoized."""
+    cached = _Z_PRECOMPUTED.get(confidence_level)
+    if cached is None:
+        cached = _Z_CACHE.get(confidence_level)
+    if cached is None:
+        cached = _compute_z(confidence_level)
+        while len(_Z_CACHE) >= _Z_CACHE_MAX_SIZE:
+            _Z_CACHE.pop(next(iter(_Z_CACHE), None), None)
+        _Z_CACHE[confidence_level] = cached
+    return cached
+
+
+def calculate_parametric_var_es(portfolio_config: dict,
+                                daily_model: DailyModel = None):
     """
     Calculates VaR and ES using the Parametric (Variance-Covariance) method.
 
@@ -27,6 +70,9 @@ def calculate_parametric_var_es(portfolio_config: dict):
             - 'confidence_level': float, e.g., 0.99 for 99%.
             - 'time_horizon_days': int, VaR/ES time horizon in days.
             - 'trading_days_per_year': int, e.g., 252.
+        daily_model (DailyModel, optional): Pre-built daily return model for this
+            portfolio (e.g. shared with the Monte Carlo method). If omitted it is
+            built from the annual figures in `portfolio_config`.
 
     Returns:
         tuple: (var_value, es_value, var_return, es_return)
@@ -45,34 +91,26 @@ def calculate_parametric_var_es(portfolio_config: dict):
     # Unpack parameters from config for easier access
     portfolio_value = portfolio_config['portfolio_value']
     weights = portfolio_config['weights']
-    annual_returns = portfolio_config['expected_annual_returns']
-    annual_vols = portfolio_config['annual_volatilities']
-    corr_matrix = portfolio_config['correlation_matrix']
     confidence_level = portfolio_config['confidence_level']
     time_horizon = portfolio_config['time_horizon_days']
-    trading_days = portfolio_config['trading_days_per_year']
 
     alpha = 1 - confidence_level  # Tail probability
 
     # 1. Convert annual figures to daily
-    # The convert_annual_to_daily function is imported from src.utils
-    daily_returns = convert_annual_to_daily(annual_returns, trading_days, is_volatility=False)
-    daily_vols = convert_annual_to_daily(annual_vols, trading_days, is_volatility=True)
+    # DailyModel (src.utils) holds the daily returns and the daily covariance matrix:
+    # Sigma_daily = diag(daily_vols) * Correlation_Matrix * diag(daily_vols)
+    if daily_model is None:
+        daily_model = DailyModel.from_config(portfolio_config)
+    daily_returns = daily_model.mu
 
     # 2. Calculate Portfolio Expected Daily Return
     # E[R_p_daily] = w^T * mu_daily
     portfolio_daily_mean_return = np.dot(weights, daily_returns)
 
-    # 3. Calculate Portfolio Daily Covariance Matrix & Variance/Volatility
-    # Daily Covariance Matrix (Sigma_daily):
-    # D_daily = diag(daily_vols)
-    # Sigma_daily = D_daily * Correlation_Matrix * D_daily
-    D_daily = np.diag(daily_vols)
-    daily_covariance_matrix = D_daily @ corr_matrix @ D_daily
-    
+    # 3. Calculate Portfolio Daily Variance/Volatility
     # Portfolio Daily Variance (sigma^2_p_daily):
-    # sigma^2_p_daily = w^T * Sigma_daily * w
-    portfolio_daily_variance = weights.T @ daily_covariance_matrix @ weights
+    # sigma^2_p_daily = w^T * Sigma_daily * w  (= ||L^T w||^2 once L has been computed)
+    portfolio_daily_variance = daily_model.portfolio_variance(weights)
     
     # Portfolio Daily Volatility (sigma_p_daily):
     # Ensure variance is not negative due to floating point issues before sqrt
@@ -91,7 +129,8 @@ def calculate_parametric_var_es(portfolio_config: dict):
 
     # 5. Calculate Parametric VaR
     # Z_alpha is the alpha-quantile of the standard normal distribution
-    z_score = scipy.stats.norm.ppf(alpha) # For left tail (losses), this will be negative
+    # The ES multiplier phi(Z_alpha) / alpha is looked up alongside it for step 6.
+    z_score, es_multiplier = _get_z(confidence_level) # For left tail (losses), Z_alpha will be negative
 
     # VaR (as a return): E[R_p_T] + sigma_p_T * Z_alpha
     # This gives the worst expected return at the given confidence level.
@@ -111,8 +150,7 @@ def calculate_parametric_var_es(portfolio_config: dict):
     elif adj_portfolio_volatility == 0: # If volatility is zero, ES is just the negative mean return if it's a loss
         es_parametric_return = adj_portfolio_mean_return
     else:
-        pdf_at_z_score = scipy.stats.norm.pdf(z_score)
-        es_parametric_return = adj_portfolio_mean_return - adj_portfolio_volatility * (pdf_at_z_score / alpha)
+        es_parametric_return = adj_portfolio_mean_return - adj_portfolio_volatility * es_multiplier
     
     # ES (as a positive loss value): -ES_return * Portfolio_Value
     es_parametric_value = -es_parametric_return * portfolio_value
@@ -4,7 +4,14 @@ Utility Functions
 This module contains helper functions for the PortfolioRiskCalculator,
 such as display formatting, input validation (if needed), etc.
 """
+import functools
+import hashlib
+import math
+import sys
+from dataclasses import dataclass
+
 import numpy as np
+from scipy.linalg import cholesky as _cholesky, LinAlgError
 
 def display_results(method_name: str,
                     var_value: float,
@@ -23,17 +30,27 @@ def display_results(method_name: str,
         es_return (float): Calculated ES as a negative return.
         portfolio_config (dict): The portfolio configuration dictionary used for calculation.
     """
-    print(f"\n--- {method_name} Results ---")
-    print(f"Portfolio: {portfolio_config.get('name', 'N/A')}")
-    print(f"Initial Portfolio Value: ${portfolio_config.get('portfolio_value', 0):,.2f}")
-    print(f"Confidence Level: {portfolio_config.get('confidence_level', 0)*100:.1f}%")
-    print(f"Time Horizon: {portfolio_config.get('time_horizon_days', 0)} days")
-    print("-" * 30)
-    print(f"VaR ({portfolio_config.get('confidence_level', 0)*100:.1f}%) Return: {var_return:,.4%}")
-    print(f"VaR ({portfolio_config.get('confidence_level', 0)*100:.1f}%) Value: ${var_value:,.2f}")
-    print(f"ES ({portfolio_config.get('confidence_level', 0)*100:.1f}%) Return: {es_return:,.4%}")
-    print(f"ES ({portfolio_config.get('confidence_level', 0)*100:.1f}%) Value: ${es_value:,.2f}")
-    print("-" * 30)
+    # Look up and format the config fields once rather than on every line
+    name = portfolio_config.get('name', 'N/A')
+    portfolio_value = portfolio_config.get('portfolio_value', 0)
+    time_horizon = portfolio_config.get('time_horizon_days', 0)
+    cl_str = f"{portfolio_config.get('confidence_level', 0)*100:.1f}%"
+
+    lines = [
+        f"\n--- {method_name} Results ---",
+        f"Portfolio: {name}",
+        f"Initial Portfolio Value: ${portfolio_value:,.2f}",
+        f"Confidence Level: {cl_str}",
+        f"Time Horizon: {time_horizon} days",
+        "-" * 30,
+        f"VaR ({cl_str}) Return: {var_return:,.4%}",
+        f"VaR ({cl_str}) Value: ${var_value:,.2f}",
+        f"ES ({cl_str}) Return: {es_return:,.4%}",
+        f"ES ({cl_str}) Value: ${es_value:,.2f}",
+        "-" * 30,
+    ]
+    # One write for the whole block instead of a print (and stdout lock) per line
+    sys.stdout.write("\n".join(lines) + "\n")
 
 
 def convert_annual_to_daily(annual_value: float, trading_days: int, is_volatility: bool = False) -> float:
@@ -41,19 +58,142 @@ def convert_annual_to_daily(annual_value: float, trading_days: int, is_volatilit
     Converts an annualized figure (return or volatility) to a daily figure.
 
     Args:
-        annual_value (float): The annualized value (e.g., 0.08 for 8%).
+        annual_value (float or np.ndarray): The annualized value (e.g., 0.08 for 8%),
+                                           or an array of them (one per asset).
         trading_days (int): The number of trading days in a year (e.g., 252).
         is_volatility (bool): True if the value is volatility (requires sqrt scaling),
                               False if it's a return (linear scaling).
 
     Returns:
-        float: The corresponding daily value.
+        float or np.ndarray: The corresponding daily value(s).
     """
     if is_volatility:
-        return annual_value / np.sqrt(trading_days)
+        # trading_days is a plain scalar, so math.sqrt avoids NumPy ufunc dispatch;
+        # array inputs are still scaled elementwise by the one scalar factor.
+        return annual_value / math.sqrt(trading_days)
     else:
         return annual_value / trading_days
 
+# Cholesky factors keyed by the covariance matrix's shape, dtype and a BLAKE2b
+# digest of its bytes, so a key never holds a copy of the matrix. Repeated calls
+# with the same covariance (e.g. several Monte Carlo runs on one portfolio)
+# factorize it only once. The cached factors are shared, so they are marked
+# read-only. The cache is bounded both in entries and in the bytes of the
+# factors it holds: the oldest entries are evicted to make room, and a factor
+# larger than the whole byte budget is returned without being cached. A stream
+# of always-new covariances (e.g. a rolling backtest) therefore pins at most
+# _CHOLESKY_CACHE_MAX_BYTES.
+_CHOLESKY_CACHE = {}
+_CHOLESKY_CACHE_MAX_SIZE = 32
+_CHOLESKY_CACHE_MAX_BYTES = 64 * 2**20
+
+
+def _cached_cholesky(cov: np.ndarray) -> np.ndarray:
+    """
+    Returns the lower Cholesky factor of `cov`, memoized on its contents.
+
+    Raises LinAlgError if `cov` is not positive definite (failures are not cached).
+    """
+    cov = np.ascontiguousarray(cov)
+    key = (cov.shape, cov.dtype.str, hashlib.blake2b(cov).digest())
+    L_matrix = _CHOLESKY_CACHE.get(key)
+    if L_matrix is None:
+        # Direct LAPACK potrf wrapper; the NaN/inf scan of check_finite is
+        # skipped here (DailyModel.L checks finiteness before calling this).
+        L_matrix = _cholesky(cov, lower=True, check_finite=False)
+        L_matrix.setflags(write=False)
+        if L_matrix.nbytes <= _CHOLESKY_CACHE_MAX_BYTES:
+            cached_bytes = sum(factor.nbytes for factor in list(_CHOLESKY_CACHE.values()))
+            while _CHOLESKY_CACHE and (len(_CHOLESKY_CACHE) >= _CHOLESKY_CACHE_MAX_SIZE
+                                       or cached_bytes + L_matrix.nbytes > _CHOLESKY_CACHE_MAX_BYTES):
+                evicted = _CHOLESKY_CACHE.pop(next(iter(_CHOLESKY_CACHE), None), None)
+                if evicted is not None:
+                    cached_bytes -= evicted.nbytes
+            _CHOLESKY_CACHE[key] = L_matrix
+    return L_matrix
+
+
+@dataclass(frozen=True, eq=False)
+class DailyModel:
+    """
+    Daily asset return model shared by the Parametric and Monte Carlo methods.
+
+    Built once per portfolio so that the annual-to-daily conversion, the daily
+    covariance matrix and its Cholesky factor are not recomputed by each method.
+    Frozen, so `cov` cannot be reassigned under a cached factor, and compared by
+    identity (the generated __eq__ cannot compare ndarrays).
+
+    Attributes:
+        mu (np.ndarray): Expected daily returns for each asset.
+        cov (np.ndarray): Daily covariance matrix of asset returns.
+        L (np.ndarray): Lower Cholesky factor of `cov` (L L^T = cov), computed
+                        on first access and cached (read-only; models with
+                        an identical `cov` share one factor).
+    """
+    mu: np.ndarray
+    cov: np.ndarray
+
+    @classmethod
+    def from_config(cls, portfolio_config: dict) -> "DailyModel":
+        """
+        Builds the daily model from a portfolio configuration's annual figures.
+
+        Args:
+            portfolio_config (dict): Must contain 'expected_annual_returns',
+                'annual_volatilities', 'correlation_matrix' and 'trading_days_per_year'.
+        """
+        trading_days = portfolio_config['trading_days_per_year']
+        daily_returns = convert_annual_to_daily(
+            portfolio_config['expected_annual_returns'], trading_days, is_volatility=False)
+        daily_vols = convert_annual_to_daily(
+            portfolio_config['annual_volatilities'], trading_days, is_volatility=True)
+        # Sigma_daily = diag(vols) * Corr * diag(vols), computed elementwise
+        daily_covariance_matrix = portfolio_config['correlation_matrix'] * np.outer(daily_vols, daily_vols)
+        return cls(mu=daily_returns, cov=daily_covariance_matrix)
+
+    @functools.cached_property
+    def L(self) -> np.ndarray:
+        # The factorization skips LAPACK's NaN/inf scan (check_finite=False), and a
+        # NaN covariance would otherwise "factorize" into NaN VaR/ES. This O(n^2)
+        # check is cheap next to the O(n^3) factorization.
+        if not np.isfinite(self.cov).all():
+            raise ValueError("Daily covariance matrix contains NaN or infinite values.")
+        try:
+            return _cached_cholesky(self.cov)
+        except LinAlgError as e:
+            # The factorization itself is the positive-definiteness check; no separate
+            # eigenvalue test is needed. In practice, might try to find nearest PD matrix.
+            raise ValueError("Daily covariance matrix is not positive definite. Cholesky decomposition failed.") from e
+
+    def factorize(self) -> bool:
+        """
+        Computes and caches the Cholesky factor `L` ahead of use.
+
+        Returns:
+            bool: True if `cov` is positive definite and `L` is now cached,
+                  False if the factorization failed (accessing `L` raises ValueError).
+        """
+        try:
+            self.L
+        except ValueError:
+            return False
+        return True
+
+    def portfolio_variance(self, weights: np.ndarray) -> float:
+        """
+        Daily portfolio variance w^T Sigma w.
+
+        If the Cholesky factor has already been computed it is reused, since
+        w^T Sigma w = ||L^T w||^2 only touches its triangle. Otherwise the
+        quadratic form is evaluated directly: factoring just for the variance
+        would cost more than it saves (and fails for singular covariances).
+        """
+        if 'L' in self.__dict__:
+            Lt_w = self.L.T @ weights
+            return float(Lt_w @ Lt_w)
+        return float(weights.T @ self.cov @ weights)
+
+
 # You can add any other utility functions here, for example:
 # def validate_portfolio_config(config):
 #     """ Validates the structure and content of a portfolio configuration. """
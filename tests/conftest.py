@@ -0,0 +1,9 @@
+# tests/conftest.py
+"""
+pytest configuration: put the project root on sys.path once so the test
+modules can import from `src` without any per-file path handling.
+"""
+import pathlib
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
@@ -4,101 +4,68 @@ Unit tests for the Monte Carlo VaR/ES calculation module.
 """
 import unittest
 import numpy as np
-import sys
-import os
-
-# --- sys.path modification to allow imports from src ---
-def _add_project_root_to_path_if_needed():
-    # Strategy:
-    # 1. Try to derive project root from __file__ (parent of parent of this file).
-    #    Check if this derived root contains a 'src' directory.
-    # 2. If not, try current working directory (os.getcwd()).
-    #    Check if CWD contains a 'src' directory.
-    # 3. If not, try parent of CWD.
-    #    Check if parent of CWD contains a 'src' directory. Muchas gracias aficion SIUUU
-
-    paths_to_check = []
-    
-    # Candidate 1: Based on __file__
-    try:
-        current_file_abspath = os.path.abspath(__file__)
-        # Assuming tests/test_monte_carlo.py, so two os.path.dirname to get to project root
-        project_root_from_file = os.path.dirname(os.path.dirname(current_file_abspath))
-        paths_to_check.append(project_root_from_file)
-    except NameError: # __file__ is not defined
-        # print("DEBUG: __file__ not defined.", file=sys.stderr) # Optional debug
-        pass
-    except Exception as e:
-        # print(f"DEBUG: Error determining path from __file__: {e}", file=sys.stderr) # Optional debug
-        pass
-
-    # Candidate 2: Current Working Directory
-    cwd = os.getcwd()
-    paths_to_check.append(cwd)
-
-    # Candidate 3: Parent of Current Working Directory
-    parent_of_cwd = os.path.dirname(cwd)
-    if parent_of_cwd != cwd: # Avoid adding '.' if cwd is root, or adding same path twice
-        if parent_of_cwd not in paths_to_check: # Avoid duplicate checks if CWD was already parent
-             paths_to_check.append(parent_of_cwd)
-    
-    # Iterate through candidate paths and add the first one that contains 'src'
-    for candidate_root in paths_to_check:
-        # Ensure candidate_root is a valid string path before os.path.isdir
-        if isinstance(candidate_root, str) and os.path.isdir(candidate_root) and \
-           os.path.isdir(os.path.join(candidate_root, "src")):
-            if candidate_root not in sys.path:
-                sys.path.insert(0, candidate_root)
-                # print(f"DEBUG: Added to sys.path: {candidate_root}", file=sys.stderr) # Optional debug
-            return # Found and added
-
-    # If no suitable path was found
-    # print(f"Warning: Could not find project root containing 'src'. Current sys.path: {sys.path}, CWD: {cwd}", file=sys.stderr) # Optional debug
-
-_add_project_root_to_path_if_needed()
-
-# Now imports from src should work
-from src.monte_carlo_method import calculate_monte_carlo_var_es
+from scipy.special import ndtr, ndtri
+
+# The project root is put on sys.path by tests/conftest.py (pytest) or by
+# running from the project root (python -m unittest / python -m tests.test_monte_carlo).
+from src.monte_carlo_method import calculate_monte_carlo_var_es, monte_carlo_workspace_size, nb, _mc_kernel
 from src.utils import convert_annual_to_daily # For test setup
+from src._mc_warmup import warm_up_numba_kernel
+
+# Inputs of the test portfolio, built once per module. They are shared by every
+# test, so they are read-only.
+_WEIGHTS = np.array([0.5, 0.3, 0.2])
+_EXP_RET = np.array([0.08, 0.03, 0.05])
+_ANN_VOL = np.array([0.15, 0.05, 0.18])
+_CORR = np.array([
+    [1.0, 0.2, 0.1],
+    [0.2, 1.0, 0.05],
+    [0.1, 0.05, 1.0]
+])
+for _array in (_WEIGHTS, _EXP_RET, _ANN_VOL, _CORR):
+    _array.setflags(write=False)
+
+# Engines available here: the Numba engine is only tested when numba is installed.
+_ENGINES = ("numpy",) + (("numba",) if nb is not None else ())
 
 class TestMonteCarloMethod(unittest.TestCase):
 
-    def setUp(self):
-        """Set up parameters for Monte Carlo tests."""
-        self.mc_config = {
+    @classmethod
+    def setUpClass(cls):
+        """Set up the parameters and daily inputs shared by the Monte Carlo tests (never mutated)."""
+        cls.mc_config = {
             "name": "MC Unit Test Portfolio",
             "portfolio_value": 1_000_000,
-            "weights": np.array([0.5, 0.3, 0.2]),
+            "weights": _WEIGHTS,
             "confidence_level": 0.95, # Using 95% for MC tests for broader tail
             "time_horizon_days": 5,
             "num_simulations": 2000,  # Keep low for fast tests, increase for accuracy checks
             "trading_days_per_year": 252, # Needed for daily conversion setup
             # These annual figures are for setting up daily inputs for the MC function
-            "expected_annual_returns": np.array([0.08, 0.03, 0.05]),
-            "annual_volatilities": np.array([0.15, 0.05, 0.18]),
-            "correlation_matrix": np.array([
-                [1.0, 0.2, 0.1],
-                [0.2, 1.0, 0.05],
-                [0.1, 0.05, 1.0]
-            ])
+            "expected_annual_returns": _EXP_RET,
+            "annual_volatilities": _ANN_VOL,
+            "correlation_matrix": _CORR
         }
 
         # Prepare daily inputs for the MC function
-        self.daily_returns = convert_annual_to_daily(
-            self.mc_config['expected_annual_returns'],
-            self.mc_config['trading_days_per_year'],
+        cls.daily_returns = convert_annual_to_daily(
+            cls.mc_config['expected_annual_returns'],
+            cls.mc_config['trading_days_per_year'],
             is_volatility=False
         )
-        self.daily_vols = convert_annual_to_daily(
-            self.mc_config['annual_volatilities'],
-            self.mc_config['trading_days_per_year'],
+        cls.daily_vols = convert_annual_to_daily(
+            cls.mc_config['annual_volatilities'],
+            cls.mc_config['trading_days_per_year'],
             is_volatility=True
         )
-        D_daily = np.diag(self.daily_vols)
-        self.daily_covariance_matrix = D_daily @ self.mc_config['correlation_matrix'] @ D_daily
-        
-        # Seed for reproducibility in tests
-        np.random.seed(42)
+        cls.daily_covariance_matrix = (
+            cls.mc_config['correlation_matrix'] * cls.daily_vols[:, None] * cls.daily_vols[None, :]
+        )
+
+    def setUp(self):
+        """Give each test its own freshly seeded Generator."""
+        # Seeded PCG64 Generator for reproducibility in tests
+        self.rng = np.random.default_rng(42)
 
 
     def test_calculation_runs(self):
@@ -107,8 +74,8 @@ class TestMonteCarloMethod(unittest.TestCase):
             calculate_monte_carlo_var_es(
                 portfolio_config=self.mc_config,
                 daily_returns=self.daily_returns,
-                daily_vols=self.daily_vols, # Not strictly used if daily_cov_matrix is passed
-                daily_covariance_matrix=self.daily_covariance_matrix
+                daily_covariance_matrix=self.daily_covariance_matrix,
+                rng=self.rng
             )
         except Exception as e:
             self.fail(f"calculate_monte_carlo_var_es raised an exception: {e}")
@@ -119,8 +86,8 @@ class TestMonteCarloMethod(unittest.TestCase):
         var_val, es_val, _, _, _ = calculate_monte_carlo_var_es(
             portfolio_config=self.mc_config,
             daily_returns=self.daily_returns,
-            daily_vols=self.daily_vols,
-            daily_covariance_matrix=self.daily_covariance_matrix
+            daily_covariance_matrix=self.daily_covariance_matrix,
+            rng=self.rng
         )
         self.assertGreaterEqual(es_val, var_val, "MC ES value should be >= VaR value")
 
@@ -129,8 +96,8 @@ class TestMonteCarloMethod(unittest.TestCase):
         _, _, var_ret, es_ret, _ = calculate_monte_carlo_var_es(
             portfolio_config=self.mc_config,
             daily_returns=self.daily_returns,
-            daily_vols=self.daily_vols,
-            daily_covariance_matrix=self.daily_covariance_matrix
+            daily_covariance_matrix=self.daily_covariance_matrix,
+            rng=self.rng
         )
         self.assertLessEqual(es_ret, var_ret, "MC ES return should be <= VaR return")
 
@@ -138,13 +105,24 @@ class TestMonteCarloMethod(unittest.TestCase):
         """Test the shape of the returned array of all simulated returns."""
         _, _, _, _, all_sim_returns = calculate_monte_carlo_var_es(
             portfolio_config=self.mc_config,
+            return_samples=True,
             daily_returns=self.daily_returns,
-            daily_vols=self.daily_vols,
-            daily_covariance_matrix=self.daily_covariance_matrix
+            daily_covariance_matrix=self.daily_covariance_matrix,
+            rng=self.rng
         )
         self.assertEqual(all_sim_returns.shape[0], self.mc_config['num_simulations'],
                          "Number of simulated returns should match num_simulations.")
 
+    def test_samples_not_returned_by_default(self):
+        """Test that the simulated returns are only returned when requested."""
+        _, _, _, _, all_sim_returns = calculate_monte_carlo_var_es(
+            portfolio_config=self.mc_config,
+            daily_returns=self.daily_returns,
+            daily_covariance_matrix=self.daily_covariance_matrix,
+            rng=self.rng
+        )
+        self.assertIsNone(all_sim_returns)
+
     def test_cholesky_error_handling(self):
         """Test that Cholesky decomposition failure is handled (if non-PD matrix)."""
         non_pd_matrix = np.array([[1.0, 2.0], [2.0, 1.0]]) # Not positive definite
@@ -156,17 +134,247 @@ class TestMonteCarloMethod(unittest.TestCase):
 
         # Dummy daily returns for 2 assets
         dummy_daily_returns = np.array([0.0, 0.0])
-        # Dummy daily vols for 2 assets (not directly used if daily_covariance_matrix is passed)
-        dummy_daily_vols = np.array([0.01, 0.01])
 
 
-        with self.assertRaises(ValueError, msg="Should raise ValueError for non-PD matrix"):
+        with self.assertRaises(ValueError, msg="Should raise ValueError for non-PD matrix") as cm:
             calculate_monte_carlo_var_es(
                 portfolio_config=temp_config, # Use modified config
                 daily_returns=dummy_daily_returns, 
-                daily_vols=dummy_daily_vols,   
                 daily_covariance_matrix=non_pd_matrix
             )
+        # The original LAPACK failure is kept as the cause
+        self.assertIsInstance(cm.exception.__cause__, np.linalg.LinAlgError)
+
+    def test_non_finite_covariance_raises(self):
+        """Test that a covariance containing NaN is rejected instead of reporting zero risk."""
+        nan_matrix = self.daily_covariance_matrix.copy()
+        nan_matrix[0, 1] = nan_matrix[1, 0] = np.nan
+        with self.assertRaises(ValueError):
+            calculate_monte_carlo_var_es(
+                portfolio_config=self.mc_config,
+                daily_returns=self.daily_returns,
+                daily_covariance_matrix=nan_matrix
+            )
+
+    def test_chunked_simulation_fills_every_path(self):
+        """Test that a tile size which does not divide num_simulations still fills every path."""
+        _, _, var_ret, es_ret, all_sim_returns = calculate_monte_carlo_var_es(
+            portfolio_config=self.mc_config,
+            return_samples=True,
+            daily_returns=self.daily_returns,
+            daily_covariance_matrix=self.daily_covariance_matrix,
+            rng=self.rng,
+            engine="numpy",
+            chunk_size=333,
+            path_dependent=True
+        )
+        self.assertEqual(all_sim_returns.shape[0], self.mc_config['num_simulations'])
+        self.assertTrue(np.all(np.isfinite(all_sim_returns)))
+        self.assertLessEqual(es_ret, var_ret)
+
+    def test_antithetic_paths_mirror_each_other(self):
+        """Test that antithetic paths use mirrored shocks and fill every path."""
+        config = dict(self.mc_config, time_horizon_days=1, num_simulations=2000)
+        daily_returns = np.zeros(3)
+        for engine in _ENGINES:
+            _, _, var_ret, es_ret, all_sim_returns = calculate_monte_carlo_var_es(
+                portfolio_config=config,
+                return_samples=True,
+                daily_returns=daily_returns,
+                daily_covariance_matrix=self.daily_covariance_matrix,
+                rng=self.rng,
+                engine=engine,
+                dtype=np.float64,
+                antithetic=True,
+                path_dependent=True
+            )
+            self.assertEqual(all_sim_returns.shape[0], config['num_simulations'])
+            self.assertLessEqual(es_ret, var_ret)
+            # With zero drift and a 1-day horizon every drawn path r has a mirror -r.
+            sorted_returns = np.sort(all_sim_returns)
+            np.testing.assert_allclose(sorted_returns, -sorted_returns[::-1], atol=1e-12)
+
+    def test_closed_form_antithetic_mirrors_with_odd_num_simulations(self):
+        """Test that the closed-form antithetic draw mirrors every pair and fills an odd path count."""
+        config = dict(self.mc_config, num_simulations=2001)
+        daily_returns = np.zeros(3)
+        _, _, var_ret, es_ret, all_sim_returns = calculate_monte_carlo_var_es(
+            portfolio_config=config,
+            return_samples=True,
+            daily_returns=daily_returns,
+            daily_covariance_matrix=self.daily_covariance_matrix,
+            rng=self.rng,
+            dtype=np.float64,
+            antithetic=True
+        )
+        self.assertEqual(all_sim_returns.shape[0], config['num_simulations'])
+        self.assertTrue(np.all(np.isfinite(all_sim_returns)))
+        self.assertLessEqual(es_ret, var_ret)
+        # With zero drift every log-return x has a mirror -x, except the one unpaired draw
+        log_returns = np.log1p(all_sim_returns)
+        has_mirror = np.isclose(log_returns[:, None], -log_returns[None, :], rtol=0, atol=1e-12).any(axis=1)
+        self.assertGreaterEqual(np.count_nonzero(has_mirror), config['num_simulations'] - 1)
+
+    def test_closed_form_matches_analytic_var_es(self):
+        """Test the closed-form VaR/ES against expm1(T*mu_p + sqrt(T)*sigma_p*z_alpha) and its tail mean."""
+        config = dict(self.mc_config, num_simulations=400000)
+        _, _, var_ret, es_ret, _ = calculate_monte_carlo_var_es(
+            portfolio_config=config,
+            daily_returns=self.daily_returns,
+            daily_covariance_matrix=self.daily_covariance_matrix,
+            seed=42,
+            dtype=np.float64
+        )
+        weights = config['weights']
+        horizon = config['time_horizon_days']
+        alpha = 1 - config['confidence_level']
+        horizon_mean = horizon * float(weights @ self.daily_returns)
+        horizon_volatility = np.sqrt(horizon * float(weights @ self.daily_covariance_matrix @ weights))
+        z_alpha = ndtri(alpha)
+        expected_var = np.expm1(horizon_mean + horizon_volatility * z_alpha)
+        # E[exp(m + s Z) - 1 | Z <= z] = exp(m + s^2 / 2) * Phi(z - s) / alpha - 1
+        expected_es = np.exp(horizon_mean + horizon_volatility**2 / 2) * ndtr(z_alpha - horizon_volatility) / alpha - 1
+        np.testing.assert_allclose(var_ret, expected_var, rtol=1e-2)
+        np.testing.assert_allclose(es_ret, expected_es, rtol=1e-2)
+
+    def test_closed_form_horizon_matches_path_simulation(self):
+        """Test that the one-step horizon draw agrees with day-by-day compounding within MC noise."""
+        config = dict(self.mc_config, num_simulations=50000)
+        results = {}
+        for path_dependent in (False, True):
+            _, _, var_ret, es_ret, all_sim_returns = calculate_monte_carlo_var_es(
+                portfolio_config=config,
+                return_samples=True,
+                daily_returns=self.daily_returns,
+                daily_covariance_matrix=self.daily_covariance_matrix,
+                seed=42,
+                path_dependent=path_dependent
+            )
+            self.assertEqual(all_sim_returns.shape[0], config['num_simulations'])
+            results[path_dependent] = (var_ret, es_ret)
+        np.testing.assert_allclose(results[False], results[True], rtol=0.05)
+
+    def test_float32_matches_float64(self):
+        """Test that the float32 simulation agrees with the float64 one within MC noise."""
+        config = dict(self.mc_config, num_simulations=50000)
+        results = {}
+        for dtype in (np.float32, np.float64):
+            _, _, var_ret, es_ret, all_sim_returns = calculate_monte_carlo_var_es(
+                portfolio_config=config,
+                return_samples=True,
+                daily_returns=self.daily_returns,
+                daily_covariance_matrix=self.daily_covariance_matrix,
+                seed=42,
+                dtype=dtype
+            )
+            self.assertEqual(all_sim_returns.dtype, dtype)
+            self.assertIsInstance(var_ret, float)
+            self.assertIsInstance(es_ret, float)
+            results[dtype] = (var_ret, es_ret)
+        np.testing.assert_allclose(results[np.float32], results[np.float64], rtol=0.05)
+
+    @unittest.skipIf(nb is None, "numba is not installed")
+    def test_numba_engine_matches_numpy_engine(self):
+        """Test that the Numba engine agrees with the NumPy engine within MC noise."""
+        config = dict(self.mc_config, num_simulations=50000)
+        results = {}
+        for engine in ("numpy", "numba"):
+            _, _, var_ret, es_ret, all_sim_returns = calculate_monte_carlo_var_es(
+                portfolio_config=config,
+                return_samples=True,
+                daily_returns=self.daily_returns,
+                daily_covariance_matrix=self.daily_covariance_matrix,
+                seed=42,
+                engine=engine,
+                path_dependent=True
+            )
+            self.assertEqual(all_sim_returns.shape[0], config['num_simulations'])
+            results[engine] = (var_ret, es_ret)
+        np.testing.assert_allclose(results["numba"], results["numpy"], rtol=0.05)
+
+    @unittest.skipIf(nb is None, "numba is not installed")
+    def test_warm_up_compiles_kernel_for_every_dtype(self):
+        """Test that the warm-up compiles the kernel for float32 and float64 outputs, and that it fills them."""
+        warm_up_numba_kernel()
+        out_dtypes = {str(signature[-1].dtype) for signature in _mc_kernel.signatures}
+        self.assertLessEqual({"float32", "float64"}, out_dtypes)
+
+        for dtype in (np.float32, np.float64):
+            workspace = np.full(self.mc_config['num_simulations'], np.nan, dtype=dtype)
+            calculate_monte_carlo_var_es(
+                self.mc_config, self.daily_returns, self.daily_covariance_matrix,
+                rng=self.rng, engine="numba", dtype=dtype, workspace=workspace,
+                path_dependent=True)
+            self.assertTrue(np.all(np.isfinite(workspace)))
+
+    @unittest.skipIf(nb is None, "numba is not installed")
+    def test_numba_engine_calls_share_no_paths(self):
+        """Test that successive Numba runs on one Generator draw disjoint sets of paths."""
+        config = dict(self.mc_config, num_simulations=5000)
+        samples = [
+            calculate_monte_carlo_var_es(
+                config, self.daily_returns, self.daily_covariance_matrix, rng=self.rng,
+                engine="numba", path_dependent=True, return_samples=True)[4]
+            for _ in range(2)
+        ]
+        self.assertEqual(np.intersect1d(samples[0], samples[1]).size, 0)
+
+    def test_workspace_is_reused_across_calls(self):
+        """Test that a preallocated workspace receives the samples and matches fresh buffers."""
+        num_simulations = self.mc_config['num_simulations']
+        for engine in _ENGINES:
+            for path_dependent in (False, True):
+                workspace = np.full(
+                    monte_carlo_workspace_size(self.mc_config, path_dependent=path_dependent),
+                    np.nan, dtype=np.float32)
+                expected = calculate_monte_carlo_var_es(
+                    self.mc_config, self.daily_returns, self.daily_covariance_matrix,
+                    seed=7, engine=engine, path_dependent=path_dependent)
+                actual = calculate_monte_carlo_var_es(
+                    self.mc_config, self.daily_returns, self.daily_covariance_matrix,
+                    seed=7, engine=engine, path_dependent=path_dependent,
+                    workspace=workspace, return_samples=True)
+                self.assertEqual(actual[:4], expected[:4])
+                # The samples are the workspace itself, not a fresh allocation
+                self.assertTrue(np.shares_memory(actual[4], workspace))
+                if path_dependent and engine == "numpy":
+                    # The tile draws went into the workspace after the returns
+                    self.assertFalse(np.isnan(workspace[num_simulations:]).any())
+
+        with self.assertRaises(ValueError):
+            calculate_monte_carlo_var_es(
+                self.mc_config, self.daily_returns, self.daily_covariance_matrix,
+                rng=self.rng, workspace=np.empty(num_simulations, dtype=np.float64))
+
+    def test_seed_and_rng_are_reproducible(self):
+        """Test that a fixed seed, or an equally seeded Generator, reproduces the results."""
+        for engine in _ENGINES:
+            for path_dependent in (False, True):
+                for antithetic in (False, True):
+                    kwargs = dict(
+                        portfolio_config=self.mc_config,
+                        daily_returns=self.daily_returns,
+                        daily_covariance_matrix=self.daily_covariance_matrix,
+                        engine=engine,
+                        antithetic=antithetic,
+                        path_dependent=path_dependent
+                    )
+                    from_seed = calculate_monte_carlo_var_es(seed=7, **kwargs)
+                    from_rng = calculate_monte_carlo_var_es(rng=np.random.default_rng(7), **kwargs)
+                    self.assertEqual(from_seed[:4], from_rng[:4])
+
+        with self.assertRaises(ValueError):
+            calculate_monte_carlo_var_es(seed=7, rng=np.random.default_rng(7), **kwargs)
+
+    def test_unknown_engine_raises(self):
+        """Test that an unknown engine name is rejected."""
+        with self.assertRaises(ValueError):
+            calculate_monte_carlo_var_es(
+                portfolio_config=self.mc_config,
+                daily_returns=self.daily_returns,
+                daily_covariance_matrix=self.daily_covariance_matrix,
+                engine="fortran"
+            )
 
     # More tests could include:
     # - Consistency checks (e.g., higher volatility input leads to higher VaR/ES, though MC noise exists).
@@ -174,6 +382,6 @@ class TestMonteCarloMethod(unittest.TestCase):
     # - If you implement different simulation methods for asset paths (e.g., GBM), test those.
 
 if __name__ == '__main__':
-    # This allows running the tests directly using `python tests/test_monte_carlo.py`
-    # The sys.path modification at the top of the file is crucial for this to work.
+    # This allows running the tests directly using `python -m tests.test_monte_carlo`
+    # from the project root.
     unittest.main()
@@ -1,79 +1,40 @@
 """
 Unit tests for the Parametric VaR/ES calculation module.
 """
+import dataclasses
 import unittest
+from unittest import mock
 import numpy as np
-import sys
-import os
-
-# --- sys.path modification to allow imports from src ---
-def _add_project_root_to_path_if_needed():
-    # Strategy:
-    # 1. Try to derive project root from __file__ (parent of parent of this file).
-    #    Check if this derived root contains a 'src' directory.
-    # 2. If not, try current working directory (os.getcwd()).
-    #    Check if CWD contains a 'src' directory.
-    # 3. If not, try parent of CWD.
-    #    Check if parent of CWD contains a 'src' directory.
-
-    paths_to_check = []
-    
-    # Candidate 1: Based on __file__
-    try:
-        current_file_abspath = os.path.abspath(__file__)
-        # Assuming tests/test_parametric.py, so two os.path.dirname to get to project root
-        project_root_from_file = os.path.dirname(os.path.dirname(current_file_abspath))
-        paths_to_check.append(project_root_from_file)
-    except NameError: # __file__ is not defined
-        # print("DEBUG: __file__ not defined.", file=sys.stderr) # Optional debug
-        pass
-    except Exception as e:
-        # print(f"DEBUG: Error determining path from __file__: {e}", file=sys.stderr) # Optional debug
-        pass
-
-    # Candidate 2: Current Working Directory
-    cwd = os.getcwd()
-    paths_to_check.append(cwd)
-
-    # Candidate 3: Parent of Current Working Directory
-    parent_of_cwd = os.path.dirname(cwd)
-    if parent_of_cwd != cwd: # Avoid adding '.' if cwd is root, or adding same path twice
-        if parent_of_cwd not in paths_to_check: # Avoid duplicate checks if CWD was already parent
-             paths_to_check.append(parent_of_cwd)
-    
-    # Iterate through candidate paths and add the first one that contains 'src'
-    for candidate_root in paths_to_check:
-        # Ensure candidate_root is a valid string path before os.path.isdir
-        if isinstance(candidate_root, str) and os.path.isdir(candidate_root) and \
-           os.path.isdir(os.path.join(candidate_root, "src")):
-            if candidate_root not in sys.path:
-                sys.path.insert(0, candidate_root)
-                # print(f"DEBUG: Added to sys.path: {candidate_root}", file=sys.stderr) # Optional debug
-            return # Found and added
-
-    # If no suitable path was found
-    # print(f"Warning: Could not find project root containing 'src'. Current sys.path: {sys.path}, CWD: {cwd}", file=sys.stderr) # Optional debug
-
-_add_project_root_to_path_if_needed()
-
-# Now imports from the 'src' package should work.
+
+# The project root is put on sys.path by tests/conftest.py (pytest) or by
+# running from the project root (python -m unittest / python -m tests.test_parametric).
+from src import parametric_method, utils
 from src.parametric_method import calculate_parametric_var_es
-from src.utils import convert_annual_to_daily # For test setup if needed
+from src.utils import convert_annual_to_daily, DailyModel # For test setup if needed
+
+# Read-only module-level inputs of the two-asset portfolio (see test_monte_carlo.py).
+_WEIGHTS = np.array([0.6, 0.4])
+_EXP_RET = np.array([0.10, 0.05])
+_ANN_VOL = np.array([0.20, 0.10])
+_CORR = np.array([
+    [1.0, 0.3],
+    [0.3, 1.0]
+])
+for _array in (_WEIGHTS, _EXP_RET, _ANN_VOL, _CORR):
+    _array.setflags(write=False)
 
 class TestParametricMethod(unittest.TestCase):
 
-    def setUp(self):
-        """Set up a sample portfolio configuration for testing."""
-        self.sample_portfolio_test = {
+    @classmethod
+    def setUpClass(cls):
+        """Set up the sample portfolio configurations shared by the tests (never mutated)."""
+        cls.sample_portfolio_test = {
             "name": "Parametric Unit Test Portfolio",
             "portfolio_value": 1_000_000,
-            "weights": np.array([0.6, 0.4]), # Two assets
-            "expected_annual_returns": np.array([0.10, 0.05]), 
-            "annual_volatilities": np.array([0.20, 0.10]),   
-            "correlation_matrix": np.array([
-                [1.0, 0.3],
-                [0.3, 1.0]
-            ]),
+            "weights": _WEIGHTS, # Two assets
+            "expected_annual_returns": _EXP_RET,
+            "annual_volatilities": _ANN_VOL,
+            "correlation_matrix": _CORR,
             "confidence_level": 0.99,
             "time_horizon_days": 1, # Using 1-day for simpler manual checks
             "trading_days_per_year": 252,
@@ -81,7 +42,7 @@ class TestParametricMethod(unittest.TestCase):
         }
 
         # Pre-calculate some known values for a very simple case (single asset, zero mean)
-        self.single_asset_zero_mean_config = {
+        cls.single_asset_zero_mean_config = {
             "name": "Single Asset Zero Mean Test",
             "portfolio_value": 1_000_000,
             "weights": np.array([1.0]),
@@ -135,6 +96,67 @@ class TestParametricMethod(unittest.TestCase):
         self.assertAlmostEqual(var_val, expected_var_val, places=1, msg="Single asset zero mean VaR value mismatch")
 
 
+    def test_cholesky_factor_matches_quadratic_form(self):
+        """Test that reusing a cached Cholesky factor gives the same VaR/ES as the quadratic form."""
+        config = self.sample_portfolio_test
+        daily_model = DailyModel.from_config(config)
+        self.assertTrue(daily_model.factorize()) # Factor up front so the variance is computed as ||L^T w||^2
+
+        expected = calculate_parametric_var_es(config)
+        actual = calculate_parametric_var_es(config, daily_model=daily_model)
+        np.testing.assert_allclose(actual, expected, rtol=1e-12)
+
+    def test_cholesky_factor_shared_for_identical_covariance(self):
+        """Test that models with the same covariance reuse one read-only Cholesky factor."""
+        config = self.sample_portfolio_test
+        first = DailyModel.from_config(config)
+        second = DailyModel.from_config(config)
+        self.assertIsNot(first.cov, second.cov)
+        self.assertIs(first.L, second.L)
+        self.assertFalse(first.L.flags.writeable)
+        np.testing.assert_allclose(first.L @ first.L.T, first.cov, rtol=1e-12)
+
+    def test_cholesky_cache_memory_stays_bounded(self):
+        """Test that a stream of always-new covariances does not grow the Cholesky cache's memory."""
+        budget = 2**20 # 1 MiB, so a few 200x200 factors (320 KB each) fill it
+        rng = np.random.default_rng(0)
+        with mock.patch.object(utils, '_CHOLESKY_CACHE_MAX_BYTES', budget):
+            for _ in range(20):
+                factor = rng.standard_normal((200, 200))
+                DailyModel(mu=np.zeros(200), cov=factor @ factor.T + 200 * np.eye(200)).L
+                cached_factors = list(utils._CHOLESKY_CACHE.values())
+                self.assertLessEqual(sum(L.nbytes for L in cached_factors), budget)
+            # Keys hold a fixed-size digest, never a copy of the covariance
+            self.assertTrue(all(len(key[2]) <= 64 for key in utils._CHOLESKY_CACHE))
+
+            # A factor larger than the whole budget is returned but not cached
+            factor = rng.standard_normal((400, 400))
+            big_model = DailyModel(mu=np.zeros(400), cov=factor @ factor.T + 400 * np.eye(400))
+            self.assertFalse(any(L is big_model.L for L in utils._CHOLESKY_CACHE.values()))
+
+    def test_z_cache_stays_bounded(self):
+        """Test that sweeping many confidence levels does not grow the Z cache without bound."""
+        for i in range(2 * parametric_method._Z_CACHE_MAX_SIZE):
+            config = dict(self.single_asset_zero_mean_config, confidence_level=0.9 + i * 1e-4)
+            calculate_parametric_var_es(config)
+        self.assertLessEqual(len(parametric_method._Z_CACHE), parametric_method._Z_CACHE_MAX_SIZE)
+        # The sweep does not evict the levels precomputed at import
+        for level in (0.90, 0.95, 0.975, 0.99, 0.995):
+            self.assertIs(parametric_method._get_z(level), parametric_method._Z_PRECOMPUTED[level])
+            self.assertNotIn(level, parametric_method._Z_CACHE)
+        self.assertFalse(hasattr(parametric_method, '_confidence_level'))
+
+    def test_daily_model_is_frozen_and_compared_by_identity(self):
+        """Test that a DailyModel's covariance cannot be swapped under its cached factor."""
+        daily_model = DailyModel.from_config(self.sample_portfolio_test)
+        daily_model.factorize()
+        with self.assertRaises(dataclasses.FrozenInstanceError):
+            daily_model.cov = np.eye(2)
+        self.assertEqual(daily_model, daily_model)
+        self.assertNotEqual(daily_model, DailyModel.from_config(self.sample_portfolio_test))
+        self.assertFalse(DailyModel(mu=np.zeros(2), cov=np.array([[1.0, 2.0], [2.0, 1.0]])).factorize())
+
+
     # Add more tests:
     # - Test with different confidence levels.
     # - Test with different time horizons.
@@ -142,6 +164,6 @@ class TestParametricMethod(unittest.TestCase):
     # - Test input validation if you add it to the main function.
 
 if __name__ == '__main__':
-    # This allows running the tests directly using `python tests/test_parametric.py`
-    # The sys.path modification at the top of the file is crucial for this to work.
+    # This allows running the tests directly using `python -m tests.test_parametric`
+    # from the project root.
     unittest.main()